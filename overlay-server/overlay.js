@@ -39,9 +39,32 @@ class TrackDisplay extends React.Component {
   }
 
   trackLoaded(data) {
-    const track  = JSON.parse(data);
+    const reader = new FileReader();
+    reader.onload = () => this.unpackTrack(data, reader.result);
+    reader.readAsArrayBuffer(data);
+  }
+
+  // Messages are a 4 byte header length, the JSON header, then the raw
+  // artwork bytes.
+  unpackTrack(blob, buffer) {
+    const headerLength = new DataView(buffer).getUint32(0);
+    const header = new Uint8Array(buffer, 4, headerLength);
+
+    const track  = JSON.parse(new TextDecoder('utf-8').decode(header));
     const deckID = track['deck_id'];
 
+    const artStart = 4 + headerLength;
+    const artEnd   = artStart + track['art_len'];
+
+    track.artwork = track['art_len'] === 0
+      ? null
+      : URL.createObjectURL(blob.slice(artStart, artEnd, track['art_mime']));
+
+    const previous = this.state.decks[deckID];
+    if (previous !== undefined && previous.artwork !== null) {
+      URL.revokeObjectURL(previous.artwork);
+    }
+
     const decks = Object.assign({}, this.state.decks, {[deckID]: track});
     this.setState({decks})
   }
@@ -4,11 +4,45 @@ import asyncio
 import websockets
 import mutagen
 import json
-import base64
+import struct
 import os
+import socket
 import signal
 import optparse
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+def json_dumps(data):
+    """Serialize data to UTF-8 encoded JSON, using orjson when it is available.
+    """
+    if orjson is None:
+        return json.dumps(data).encode('utf-8')
+
+    return orjson.dumps(data)
+
+def pack_trackload(metadata):
+    """Pack track metadata into a binary websocket message.
+
+    The message is laid out as a 4 byte big-endian header length, the JSON
+    header, followed by the raw artwork bytes. The header includes the
+    `art_mime` and `art_len` of the artwork so it can be sliced back out.
+    """
+    metadata = dict(metadata)
+    artwork  = metadata.pop('artwork') or b''
+
+    metadata['art_len'] = len(artwork)
+    header = json_dumps(metadata)
+
+    return struct.pack('>I', len(header)) + header + artwork
+
 class TrackloadWebsocketServer(object):
     """
     This is a websocket server that connects to the CDJ broadcast server to be
@@ -37,55 +71,111 @@ class TrackloadWebsocketServer(object):
 
         track = mutagen.File(full_path).tags
 
-        # Convert the artwork into base 64
+        # Artwork is sent as raw bytes after the JSON header
         art = track.getall('APIC')
-        artwork = None
+        artwork  = None
+        art_mime = None
 
         if len(art) > 0:
-            data = base64.b64encode(art[0].data).decode('utf-8')
-            mime = art[0].mime
-
-            artwork = 'data:{mime};base64,{data}'.format(mime=mime, data=data)
+            artwork  = art[0].data
+            art_mime = art[0].mime
 
         release = track.getall('COMM')
         if len(release) > 0: release = release[0].text
 
         return {
-            'deck_id': int(deck_id),
-            'artist':  track['TPE1'].text[0],
-            'title':   track['TIT2'].text[0],
-            'album':   track['TALB'].text[0] if 'TALB' in track else None,
-            'key':     track['TKEY'].text[0] if 'TKEY' in track else None,
-            'label':   track['TPUB'].text[0] if 'TPUB' in track else None,
-            'year':    track['TDRC'].text[0].get_text() if 'TDRC' in track else None,
-            'release': release,
-            'artwork': artwork,
+            'deck_id':  int(deck_id),
+            'artist':   track['TPE1'].text[0],
+            'title':    track['TIT2'].text[0],
+            'album':    track['TALB'].text[0] if 'TALB' in track else None,
+            'key':      track['TKEY'].text[0] if 'TKEY' in track else None,
+            'label':    track['TPUB'].text[0] if 'TPUB' in track else None,
+            'year':     track['TDRC'].text[0].get_text() if 'TDRC' in track else None,
+            'release':  release,
+            'art_mime': art_mime,
+            'artwork':  artwork,
         }
 
+    async def __connect_broadcast(self):
+        """Open a non-blocking socket connected to the broadcast server.
+        """
+        loop = asyncio.get_event_loop()
+
+        addresses = await loop.getaddrinfo(*self.broadcast_server, type=socket.SOCK_STREAM)
+        family, sock_type, proto, _, address = addresses[0]
+
+        sock = socket.socket(family, sock_type, proto)
+        sock.setblocking(False)
+
+        await loop.sock_connect(sock, address)
+
+        return sock
+
+    async def __read_lines(self, sock):
+        """Yield decoded lines read from the socket until it is closed.
+
+        Data is received directly into a single reused buffer and lines are
+        decoded out of it, rather than copied through a StreamReader.
+        """
+        loop   = asyncio.get_event_loop()
+        buffer = bytearray(4096)
+        view   = memoryview(buffer)
+
+        start, end = 0, 0
+
+        while True:
+            newline = buffer.find(b'\n', start, end)
+
+            if newline != -1:
+                yield str(view[start:newline], 'utf-8')
+                start = newline + 1
+                continue
+
+            # Move the partial line to the front of the buffer, growing the
+            # buffer if the line does not fit.
+            buffer[:end - start] = buffer[start:end]
+            start, end = 0, end - start
+
+            if end == len(buffer):
+                view.release()
+                buffer = buffer + bytearray(len(buffer))
+                view   = memoryview(buffer)
+
+            received = await loop.sock_recv_into(sock, view[end:])
+
+            if received == 0:
+                return
+
+            end += received
+
     async def trackload(self, websocket, path):
         """Coroutine that will wait for tracks to be loaded from the broadcast
         server, promptly sending JSON to the websocket with information about
         the track that was loaded.
         """
-        reader, writer = await asyncio.open_connection(*self.broadcast_server)
-
-        while True:
-            data = await reader.readline()
+        sock = await self.__connect_broadcast()
 
-            load_line = data.decode().rstrip()
-            details = self.__track_details(load_line)
-            details = json.dumps(details)
+        try:
+            async for line in self.__read_lines(sock):
+                load_line = line.rstrip()
+                details = self.__track_details(load_line)
+                details = pack_trackload(details)
 
-            await websocket.send(details)
+                await websocket.send(details)
+        finally:
+            sock.close()
 
     def start(self):
         """Start the server in the asyncio event loop.
         """
-        server = websockets.serve(self.trackload, *self.websocket_server)
+        server = websockets.serve(self.trackload, *self.websocket_server, compression=None)
 
         asyncio.get_event_loop().run_until_complete(server)
 
 if __name__ == '__main__':
+    if uvloop is not None:
+        uvloop.install()
+
     parser = optparse.OptionParser()
     parser.add_option('-m', '--music-path', dest='music_path')
 
@@ -7,22 +7,75 @@ import collections
 import optparse
 import os
 import mutagen
-import base64
+import struct
 import websockets
 import asyncio
 import json
 import functools
+import concurrent.futures
+import socket
+import ctypes
+import logging
+import io
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+logger = logging.getLogger(__name__)
+
+def json_dumps(data):
+    """Serialize data to UTF-8 encoded JSON, using orjson when it is available.
+    """
+    if orjson is None:
+        return json.dumps(data).encode('utf-8')
+
+    return orjson.dumps(data)
 
-def hex2str(data): return ":".join("{:02x}".format(ord(c)) for c in data)
+def pack_trackload(metadata):
+    """Pack track metadata into a binary websocket message.
+
+    The message is laid out as a 4 byte big-endian header length, the JSON
+    header, followed by the raw artwork bytes. The header includes the
+    `art_mime` and `art_len` of the artwork so it can be sliced back out.
+    """
+    metadata = dict(metadata)
+    artwork  = metadata.pop('artwork') or b''
+
+    metadata['art_len'] = len(artwork)
+    header = json_dumps(metadata)
+
+    return struct.pack('>I', len(header)) + header + artwork
 
 def debug_packet_pair(packet_pair):
-    print("Packet identifier: {}".format(hex2str(packet_pair.identifier)))
-    print('>>>')
-    print('\n'.join(hex2str(p.command) + ' - ' +  hex2str(p.data) for p in packet_pair.first))
-    print('<<<')
-    print('\n'.join(hex2str(p.command) + ' - ' +  hex2str(p.data) for p in packet_pair.second))
-    print('---')
-    print('')
+    """Log the hex contents of a packet pair at the debug level.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    def command_hex(part):
+        return None if part.command is None else '{:08x}'.format(part.command)
+
+    logger.debug('\n'.join([
+        "Packet identifier: {}".format(packet_pair.identifier.hex(':')),
+        '>>>',
+        '\n'.join('{!s:>8} - {}'.format(command_hex(p), p.data.hex(':')) for p in packet_pair.first),
+        '<<<',
+        '\n'.join('{!s:>8} - {}'.format(command_hex(p), p.data.hex(':')) for p in packet_pair.second),
+        '---',
+    ]))
 
 
 # When the CDJs / Rekordbox talk to each other a packet is sent and the
@@ -35,12 +88,25 @@ PacketPair = collections.namedtuple('PacketPair', ['identifier', 'first', 'secon
 
 # Each packet communicated to and from the CDJ contains multiple parts. Each
 # part is constructed of the packet identifier, a 'command' issued by the part,
-# and some data.
+# and some data. The command is an integer (None if the part is too short to
+# have one) and the data is a memoryview into the original packet.
 PacketPart = collections.namedtuple('PacketPart', ['identifier', 'command', 'data'])
 
 # This header starts each "section" of a packet
 CDJ_SECTION_MARKER = b'\x11\x87\x23\x49\xae\x11'
 
+# Commands are read as a big-endian integer
+CDJ_COMMAND = struct.Struct('>I')
+
+def connection_key(src, sport, dst, dport):
+    """Construct a key identifying the TCP connection of a packet.
+
+    A packet and its response travel in opposite directions, so the key is the
+    same for both directions of the connection.
+    """
+    return tuple(sorted([(src, sport), (dst, dport)]))
+
+
 class CDJDataParser(object):
     """Reads packets from the CDJs and pairs them two at a time.
     """
@@ -55,32 +121,49 @@ class CDJDataParser(object):
         if data[:6] != CDJ_SECTION_MARKER:
             return
 
-        # Split the packet into sections, Ignore the first empty element
-        packet_items = data.split(CDJ_SECTION_MARKER)[1:]
+        # Sections are sliced out of a memoryview so the part data shares the
+        # packet buffer instead of being copied.
+        view  = memoryview(data)
+        parts = []
+        start = len(CDJ_SECTION_MARKER)
 
-        # Ignore empty data
-        if not packet_items:
-            return
+        while True:
+            end = data.find(CDJ_SECTION_MARKER, start)
+            section = view[start:end if end != -1 else len(data)]
 
-        # CDJ packets are made of 3 sections (as far as I can tell).
-        #
-        # 1. The first four bytes are the 'identifier' for the associated
-        #    response packet.
-        #
-        # 2. The next byte appears to be some kinda of separator, followed by
-        #    four more bytes which seems to be the 'command' for the packet.
-        #
-        # The rest of the packet is data.
-        return [PacketPart(p[:4], p[5:9], p[10:]) for p in packet_items]
+            # CDJ packets are made of 3 sections (as far as I can tell).
+            #
+            # 1. The first four bytes are the 'identifier' for the associated
+            #    response packet.
+            #
+            # 2. The next byte appears to be some kinda of separator, followed
+            #    by four more bytes which seems to be the 'command' for the
+            #    packet.
+            #
+            # The rest of the packet is data.
+            command = CDJ_COMMAND.unpack_from(section, 5)[0] if len(section) >= 9 else None
+
+            parts.append(PacketPart(bytes(section[:4]), command, section[10:]))
+
+            if end == -1:
+                return parts
+
+            start = end + len(CDJ_SECTION_MARKER)
+
+    # Limit of packets waiting to be paired, the oldest are discarded first
+    MAX_UNPAIRED_PACKETS = 1024
 
     def __init__(self):
-        self.initial_packets = {}
+        self.initial_packets = collections.OrderedDict()
 
-    def pair_packet(self, data):
+    def pair_packet(self, data, connection=None):
         """Pair a TCP packet with the associated CDJ packet it belongs to
 
         When a packet is paried to a previous packet with the same identifier
         this method will return the PacketPair, returns None otherwise.
+
+        Packets are only paired within the same `connection`, see
+        `connection_key`.
         """
         parts = CDJDataParser.parse_data(data)
 
@@ -95,13 +178,20 @@ class CDJDataParser(object):
         # For now use the identifier of the first part
         identifier = parts[0].identifier
 
-        if identifier not in self.initial_packets:
-            self.initial_packets[identifier] = parts
-        else:
-            first_parts = self.initial_packets.pop(identifier)
+        # Identifiers are only unique within a single TCP connection
+        key = (connection, identifier)
+
+        first_parts = self.initial_packets.pop(key, None)
 
+        if first_parts is not None:
             return PacketPair(identifier, first_parts, parts)
 
+        # Not all packets are paired, don't let those build up forever
+        self.initial_packets[key] = parts
+
+        if len(self.initial_packets) > CDJDataParser.MAX_UNPAIRED_PACKETS:
+            self.initial_packets.popitem(last=False)
+
         # Explicity return nothing if we haven't paired a packet yet
         return None
 
@@ -109,29 +199,34 @@ class CDJDataParser(object):
 class TrackLoadStateMachine(object):
     """State machine to keep track of a track load sequence.
     """
+    @staticmethod
+    def command_matcher(command):
+        """Construct a state operation verifying that the command of the first
+        part matches the given command.
+        """
+        return lambda parts: parts[0].command == command
+
     def __init__(self):
         self.state = 0
         self.command_states = [
             lambda p: p[0].data[18:21] == b'\x03\x04\x01',
-            b'\x30\x00\x0f\x06',       # Begin track loading
-            b'\x21\x02\x0f\x02',       # (?) Unsure
-            b'\x30\x00\x0f\x06',       # Track data request (filename!)
+            0x30000f06,                # Begin track loading
+            0x21020f02,                # (?) Unsure
+            0x30000f06,                # Track data request (filename!)
+        ]
+
+        # If the state operation is a command assume that we want to verify that
+        # the command of the first part matches the configured state transition
+        self.command_states = [
+            s if callable(s) else TrackLoadStateMachine.command_matcher(s)
+            for s in self.command_states
         ]
 
     def transition_packet(self, packet_pair):
         """Transition the machine via a packet
         """
-        state_transition = self.command_states[self.state]
-
-        state_operation = state_transition
-
-        # If the state operation is a string assume that we want to verify that
-        # the command of the first part matches the configured state transition
-        if not hasattr(state_operation, '__call__'):
-            state_operation = lambda x: x[0].command == state_transition
-
         # Check if this packet fufills the state operation
-        if not state_operation(packet_pair.first):
+        if not self.command_states[self.state](packet_pair.first):
             self.state = 0
             return
 
@@ -152,107 +247,602 @@ def get_track_load_details(packet_pair):
     """
     cdj_id = packet_pair.first[0].data[17]
 
-    path = packet_pair.second[5].data[36:].split(b'\x00\x00\x11')[0]
-    path = path.decode('utf-16-be').encode('utf-8').rstrip()
+    data = bytes(packet_pair.second[5].data[36:])
+    end  = data.find(b'\x00\x00\x11')
+
+    # The path is UTF-16 followed by NUL padding. Strip the padding after
+    # decoding so that only whole code units are removed.
+    path = data[:end if end != -1 else len(data)].decode('utf-16-be')
+    path = path.rstrip('\x00').rstrip()
 
     return (cdj_id, path)
 
 
-def get_track_metadata(cdj_id, path):
-    """Construct metadata from the ID3 tags of the file.
+# Artwork larger than this is downscaled before it is sent to the overlay
+MAX_ARTWORK_BYTES = 64 * 1024
+ARTWORK_SIZE      = (256, 256)
+
+
+def shrink_artwork(data, mime):
+    """Downscale large artwork into a JPEG thumbnail.
+
+    Returns the (data, mime) of the artwork to send. Artwork is returned
+    unchanged if it is already small enough, if Pillow is not installed, or
+    if the image can not be read.
+    """
+    if PIL is None or len(data) <= MAX_ARTWORK_BYTES:
+        return data, mime
+
+    try:
+        image = PIL.Image.open(io.BytesIO(data))
+        image.thumbnail(ARTWORK_SIZE)
+
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, 'JPEG', quality=82)
+    except Exception:
+        # Pillow plugins raise all sorts of errors on malformed images
+        logger.warning("Unable to downscale %s artwork, sending it unchanged", mime, exc_info=True)
+        return data, mime
+
+    return buffer.getvalue(), 'image/jpeg'
+
+
+# ID3v2 tag and frame headers. Sizes in the tag header (and frame headers of
+# ID3v2.4) are stored as 'syncsafe' integers.
+ID3_HEADER       = struct.Struct('>3sBBBI')
+ID3_FRAME_HEADER = struct.Struct('>4sIH')
+
+# Frames read by the ID3 reader. ID3v2.3 stores the year in TYER.
+ID3_FRAMES = {b'TPE1', b'TIT2', b'TALB', b'TKEY', b'TPUB', b'TDRC', b'TYER', b'COMM', b'APIC'}
+
+# Frame format flags (compression, encryption, unsynchronisation, etc) that
+# the ID3 reader does not handle, by ID3v2 major version.
+ID3_UNHANDLED_FLAGS = {3: 0x00e0, 4: 0x004f}
+
+# Text encodings, indexed by the encoding byte that starts text frames
+ID3_ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+
+def syncsafe(value):
+    """Decode a 32 bit syncsafe integer, where the top bit of each byte is
+    unused.
+    """
+    return ((value & 0x7f000000) >> 3 | (value & 0x7f0000) >> 2 |
+            (value & 0x7f00) >> 1 | (value & 0x7f))
+
+
+def is_id3_frame_end(tag, offset):
+    """Check that a frame ending at offset is followed by another frame ID,
+    padding, or the end of the tag.
+    """
+    if offset == len(tag) or tag[offset] == 0:
+        return True
+
+    frame_id = tag[offset:offset + 4]
+
+    return len(frame_id) == 4 and frame_id.isalnum() and frame_id.upper() == frame_id
+
+
+def walk_id3_frames(tag, syncsafe_sizes):
+    """Walk the frames of the tag, returning a dict of frame IDs to the
+    (start, end, flags) of the first frame with that ID.
+
+    Returns None if a frame does not end at another frame, padding, or the
+    end of the tag, meaning the frame sizes were read incorrectly.
+    """
+    frames = {}
+    offset = 0
+
+    while offset + ID3_FRAME_HEADER.size <= len(tag):
+        frame_id, size, flags = ID3_FRAME_HEADER.unpack_from(tag, offset)
+
+        # Padding follows the last frame
+        if tag[offset] == 0:
+            break
+
+        if syncsafe_sizes:
+            size = syncsafe(size)
+
+        start = offset + ID3_FRAME_HEADER.size
+        end   = start + size
+
+        if end > len(tag) or not is_id3_frame_end(tag, end):
+            return None
+
+        if frame_id in ID3_FRAMES and frame_id not in frames:
+            frames[frame_id] = (start, end, flags)
+
+        offset = end
+
+    return frames
+
+
+def read_id3_frames(path):
+    """Read the ID3v2 frames of the file needed to construct track metadata.
+
+    Returns the tag data and a dict of frame IDs to the (start, end) offsets
+    of the first frame body with that ID. Returns None if the file does not
+    start with an ID3v2.3 or ID3v2.4 tag, the tag uses features that are not
+    handled here, or its frame sizes can not be read consistently.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(ID3_HEADER.size)
+
+        if len(header) < ID3_HEADER.size:
+            return None
+
+        magic, major, _, flags, size = ID3_HEADER.unpack(header)
+
+        # Leave unsynchronised tags and extended headers to mutagen
+        if magic != b'ID3' or major not in ID3_UNHANDLED_FLAGS or flags & 0xc0:
+            return None
+
+        tag = f.read(syncsafe(size))
+
+    frames = walk_id3_frames(tag, syncsafe_sizes=major == 4)
+
+    # Some taggers (notably iTunes) write plain frame sizes in ID3v2.4 tags
+    if frames is None and major == 4:
+        frames = walk_id3_frames(tag, syncsafe_sizes=False)
+
+    if frames is None:
+        return None
+
+    if any(flags & ID3_UNHANDLED_FLAGS[major] for _, _, flags in frames.values()):
+        return None
+
+    frames = {frame_id: (start, end) for frame_id, (start, end, _) in frames.items()}
+
+    return tag, frames
+
+
+def read_id3_tags(path):
+    """Construct metadata by reading the ID3 frames of the file directly.
+
+    Only the frames needed for the metadata are decoded and the artwork is a
+    memoryview into the tag data. Returns None if the tag could not be read,
+    in which case mutagen should be used.
+    """
+    id3 = read_id3_frames(path)
+
+    if id3 is None:
+        return None
+
+    tag, frames = id3
+
+    def values(frame_id, skip=0):
+        if frame_id not in frames:
+            return None
+
+        start, end = frames[frame_id]
+
+        if end - start <= skip:
+            return None
+
+        encoding = ID3_ENCODINGS[tag[start]]
+        text = tag[start + 1 + skip:end].decode(encoding)
+
+        # Multiple values are NUL separated. In UTF-16 each has its own BOM.
+        values = [v.lstrip('\ufeff') for v in text.split('\x00')]
+
+        if len(values) > 1 and values[-1] == '':
+            values.pop()
+
+        return values
+
+    def text(frame_id):
+        frame = values(frame_id)
+        return frame[0] if frame else None
+
+    # Artwork is sent as raw bytes after the JSON header
+    artwork  = None
+    art_mime = None
+
+    if b'APIC' in frames:
+        start, end = frames[b'APIC']
+
+        encoding = tag[start]
+        mime_end = tag.find(b'\x00', start + 1, end)
+
+        if mime_end == -1:
+            return None
+
+        # The description follows the mime and one byte picture type, ending
+        # with a NUL in the frame's text encoding.
+        terminator = b'\x00' if encoding in (0, 3) else b'\x00\x00'
+        desc_start = mime_end + 2
+        desc_end   = tag.find(terminator, desc_start, end)
+
+        while desc_end != -1 and (desc_end - desc_start) % len(terminator):
+            desc_end = tag.find(terminator, desc_end + 1, end)
+
+        if desc_end == -1:
+            return None
+
+        artwork  = memoryview(tag)[desc_end + len(terminator):end]
+        art_mime = tag[start + 1:mime_end].decode('latin-1')
+
+        artwork, art_mime = shrink_artwork(artwork, art_mime)
+
+    # The comment starts with a three byte language and a description
+    release = values(b'COMM', skip=3)
+    release = release[1:] if release is not None else []
+
+    return {
+        'artist':   text(b'TPE1'),
+        'title':    text(b'TIT2'),
+        'album':    text(b'TALB'),
+        'key':      text(b'TKEY'),
+        'label':    text(b'TPUB'),
+        'year':     text(b'TDRC') or text(b'TYER'),
+        'release':  release,
+        'art_mime': art_mime,
+        'artwork':  artwork,
+    }
+
+
+def read_mutagen_tags(path):
+    """Construct metadata from the ID3 tags of the file using mutagen.
     """
     track = mutagen.File(path).tags
 
-    # Convert the artwork into base 64
+    # Artwork is sent as raw bytes after the JSON header
     art = track.getall('APIC')
-    artwork = None
+    artwork  = None
+    art_mime = None
 
     if len(art) > 0:
-        data = base64.b64encode(art[0].data).decode('utf-8')
-        mime = art[0].mime
-
-        artwork = 'data:{mime};base64,{data}'.format(mime=mime, data=data)
+        artwork, art_mime = shrink_artwork(art[0].data, art[0].mime)
 
     release = track.getall('COMM')
     if len(release) > 0: release = release[0].text
 
+    def text(frame_id):
+        frame = track.get(frame_id)
+        return frame.text[0] if frame is not None else None
+
+    year = text('TDRC')
+
     return {
-        'deck_id': cdj_id,
-        'artist':  track['TPE1'].text[0],
-        'title':   track['TIT2'].text[0],
-        'album':   track['TALB'].text[0] if 'TALB' in track else None,
-        'key':     track['TKEY'].text[0] if 'TKEY' in track else None,
-        'label':   track['TPUB'].text[0] if 'TPUB' in track else None,
-        'year':    track['TDRC'].text[0].get_text() if 'TDRC' in track else None,
-        'release': release,
-        'artwork': artwork,
+        'artist':   text('TPE1'),
+        'title':    text('TIT2'),
+        'album':    text('TALB'),
+        'key':      text('TKEY'),
+        'label':    text('TPUB'),
+        'year':     year.get_text() if year is not None else None,
+        'release':  release,
+        'art_mime': art_mime,
+        'artwork':  artwork,
     }
 
 
+def read_track_tags(path):
+    """Construct metadata from the ID3 tags of the file.
+
+    Tags are read directly when possible, falling back to mutagen for files
+    the ID3 reader does not handle.
+    """
+    # Malformed frames are left to mutagen as well
+    try:
+        tags = read_id3_tags(path)
+    except (IndexError, UnicodeDecodeError):
+        tags = None
+
+    if tags is None:
+        tags = read_mutagen_tags(path)
+
+    return tags
+
+
+class TrackTagCache(object):
+    """Least recently used cache of track tags.
+
+    The cache is bounded by both the number of tracks and the total size of
+    their artwork, so that tracks with large embedded artwork do not grow it
+    without limit. Entries are evicted oldest first.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.size        = 0
+        self.entries     = collections.OrderedDict()
+        self.lock        = threading.Lock()
+
+    def get(self, key):
+        """Get the cached tags for the key, returns None if not cached.
+        """
+        with self.lock:
+            tags = self.entries.get(key)
+
+            if tags is not None:
+                self.entries.move_to_end(key)
+
+            return tags
+
+    def put(self, key, tags):
+        """Cache the tags for the key.
+
+        The artwork is copied into its own bytes so it doesn't keep the rest
+        of the tag data alive. Tags with artwork larger than the whole cache
+        are not cached.
+        """
+        artwork = tags['artwork']
+        size    = len(artwork) if artwork is not None else 0
+
+        if size > self.max_bytes:
+            return
+
+        if artwork is not None:
+            tags = dict(tags, artwork=bytes(artwork))
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self.entries[key] = tags
+            self.size += size
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+
+                if evicted['artwork'] is not None:
+                    self.size -= len(evicted['artwork'])
+
+
+# Tags of recently loaded tracks, so reloading a track will not reread the file
+track_tags = TrackTagCache(max_entries=256, max_bytes=32 * 1024 * 1024)
+
+
+def get_track_metadata(cdj_id, path):
+    """Construct the metadata for a track loaded on a CDJ.
+
+    Tags are cached by path. The modification time is part of the cache key
+    so that a retagged file will be read again.
+    """
+    key  = (path, os.path.getmtime(path))
+    tags = track_tags.get(key)
+
+    if tags is None:
+        tags = read_track_tags(path)
+        track_tags.put(key, tags)
+
+    return dict(tags, deck_id=cdj_id)
+
+
+def load_trackload(cdj_id, path):
+    """Read the metadata of a loaded track and pack it into a websocket message.
+    """
+    return pack_trackload(get_track_metadata(cdj_id, path))
+
+
+# Linux packet socket constants, not all of which are exposed by `socket`
+ETH_P_ALL             = 0x0003
+ETH_P_IP              = 0x0800
+ARPHRD_LOOPBACK       = 772
+SOL_PACKET            = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_PROMISC     = 1
+SO_ATTACH_FILTER      = 26
+SKF_AD_PROTOCOL       = 0xfffff000
+
+# struct packet_mreq, used to put an interface into promiscuous mode
+PACKET_MREQ = struct.Struct('iHH8s')
+
+# Classic BPF program accepting only IPv4 TCP packets. The packet socket
+# receives all protocols, so the packet's skb->protocol is checked first. The
+# socket is cooked (SOCK_DGRAM), so offsets start at the IP header on any link
+# type.
+TCP_FILTER = [
+    (0x28, 0, 0, SKF_AD_PROTOCOL),  # ld proto       ; skb->protocol
+    (0x15, 0, 3, ETH_P_IP),         # jeq #0x800, L1, L3
+    (0x30, 0, 0, 0x00000009),       # L1: ldb [9]    ; IPv4 protocol
+    (0x15, 0, 1, 0x00000006),       # jeq #6, L2, L3 ; TCP
+    (0x06, 0, 0, 0x00040000),       # L2: ret #262144
+    (0x06, 0, 0, 0x00000000),       # L3: ret #0
+]
+
+# Fixed portion of the IPv4 header, and the TCP ports
+IPV4_HEADER = struct.Struct('!BBHHHBBHII')
+TCP_PORTS   = struct.Struct('!HH')
+
+
+def sniff_tcp_payloads(callback):
+    """Sniff TCP payloads using a Linux AF_PACKET socket.
+
+    Like scapy, every interface is put into promiscuous mode (for as long as
+    the socket is open) so that traffic between CDJs seen through a hub or
+    mirror port is captured.
+
+    Packets are filtered to TCP in the kernel and the IPv4 and TCP headers
+    are parsed by hand, calling `callback` with the connection key and
+    payload of each packet that carries CDJ data. This avoids dissecting
+    every packet with scapy.
+    """
+    # Like scapy, use ETH_P_ALL. Sockets bound to a single protocol are not
+    # passed packets sent by this host.
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_ALL))
+
+    for index, name in socket.if_nameindex():
+        mreq = PACKET_MREQ.pack(index, PACKET_MR_PROMISC, 0, b'')
+
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            logger.warning("Unable to enable promiscuous mode on %s: %s", name, e)
+
+    program = b''.join(struct.pack('HBBI', *op) for op in TCP_FILTER)
+    program = ctypes.create_string_buffer(program)
+
+    fprog = struct.pack('HP', len(TCP_FILTER), ctypes.addressof(program))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+    while True:
+        packet, (_, _, packet_type, hardware_type, _) = sock.recvfrom(65535)
+
+        # Loopback packets are seen going out and again coming in
+        if hardware_type == ARPHRD_LOOPBACK and packet_type == socket.PACKET_OUTGOING:
+            continue
+
+        # Packets are seen before the kernel validates them, so don't trust
+        # any of the header fields.
+        if len(packet) < IPV4_HEADER.size:
+            continue
+
+        ip_header = IPV4_HEADER.unpack_from(packet)
+        ihl, total_length = ip_header[0] & 0x0f, ip_header[2]
+        src, dst = ip_header[8], ip_header[9]
+
+        # The IP total length excludes any link layer padding
+        tcp_start = ihl * 4
+        ip_end    = total_length
+
+        if ihl < 5 or not tcp_start + 20 <= ip_end <= len(packet):
+            continue
+
+        data_start = tcp_start + (packet[tcp_start + 12] >> 4) * 4
+
+        # Do not deal with packets that carry no data
+        if data_start >= ip_end:
+            continue
+
+        # Most traffic is not for the CDJs, drop it before copying the payload
+        if not packet.startswith(CDJ_SECTION_MARKER, data_start):
+            continue
+
+        sport, dport = TCP_PORTS.unpack_from(packet, tcp_start)
+
+        callback(connection_key(src, sport, dst, dport), packet[data_start:ip_end])
+
+
 if __name__ == '__main__':
+    if uvloop is not None:
+        uvloop.install()
+
     data_parser   = CDJDataParser()
     state_machine = TrackLoadStateMachine()
 
     parser = optparse.OptionParser()
     parser.add_option('-a', '--addr', dest='addr', default='0.0.0.0')
     parser.add_option('-p', '--port', dest='port', default=8008)
+    parser.add_option('-d', '--debug', dest='debug', action='store_true')
 
     opts, args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO)
+
+    # Only show our own debug output, not that of websockets, asyncio, etc
+    if opts.debug:
+        logger.setLevel(logging.DEBUG)
+
     loop = asyncio.get_event_loop()
-    client_queues = []
+    clients = set()
+
+    # Reading ID3 tags hits the disk, keep it off the sniffer and event loop
+    metadata_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    # Sequence number of the latest load on each deck. Loads may finish out
+    # of order in the metadata pool, only the latest is broadcast.
+    deck_loads = {}
 
     async def handle_websocket(websocket, path):
         """Handle an opened websocket connection.
         """
-        data_queue = asyncio.Queue(loop=loop)
-        client_queues.append(data_queue)
+        clients.add(websocket)
 
-        while True:
-            data = await data_queue.get()
-            await websocket.send(data)
+        try:
+            await websocket.wait_closed()
+        finally:
+            clients.discard(websocket)
 
 
-    def broadcast_trackload(metadata):
-        """Broadcast metadata to all client queues to be sent.
+    async def broadcast_trackload(cdj_id, path):
+        """Read the track metadata in the metadata pool and broadcast it to all
+        connected websocket clients.
         """
-        for q in client_queues: q.put_nowait(metadata)
+        load = deck_loads.get(cdj_id, 0) + 1
+        deck_loads[cdj_id] = load
+
+        # Nobody is listening, don't bother reading or packing the metadata
+        if not clients:
+            return
+
+        try:
+            metadata = await loop.run_in_executor(metadata_pool, load_trackload, cdj_id, path)
+        except Exception:
+            logger.exception("Failed to read metadata for deck %s: %s", cdj_id, path)
+            return
+
+        # A later track was loaded onto the deck while this one was read
+        if deck_loads[cdj_id] != load:
+            return
+
+        websockets.broadcast(clients, metadata)
 
 
     def handle_packet(packet):
-        """Extract the packet load and pass it into the packet state machine.
+        """Extract the packet load of a scapy packet and handle it.
         """
-        payload = packet['TCP'].payload
+        # Padding is a subclass of Raw, but getlayer only matches Raw itself
+        payload = packet.getlayer(scapy.packet.Raw)
 
-        # Do not deal with padding packets
-        if isinstance(payload, scapy.packet.Padding):
+        # Ensure the packet contains raw data
+        if payload is None:
             return
 
-        # Ensure the packet contains raw data
-        if not isinstance(payload, scapy.packet.Raw):
+        data = payload.load
+
+        # Most traffic is not for the CDJs, drop it before pairing
+        if not data.startswith(CDJ_SECTION_MARKER):
             return
 
+        tcp = packet['TCP']
+        ip  = tcp.underlayer
+
+        handle_payload(connection_key(ip.src, tcp.sport, ip.dst, tcp.dport), data)
+
+
+    def handle_payload(connection, data):
+        """Pass the TCP payload into the packet state machine.
+        """
         # Pair up CDJ packets
-        packet_pair = data_parser.pair_packet(payload.load)
+        packet_pair = data_parser.pair_packet(data, connection)
 
         if packet_pair is None:
             return
 
+        debug_packet_pair(packet_pair)
+
         # Look for track-load transition sequences
         if not state_machine.transition_packet(packet_pair):
             return
 
         cdj_id, path = get_track_load_details(packet_pair)
-        metadata = json.dumps(get_track_metadata(cdj_id, path))
 
-        # Send metadata to websockets
-        loop.call_soon_threadsafe(broadcast_trackload, metadata)
+        # Read and send metadata to websockets off of the sniffer thread
+        asyncio.run_coroutine_threadsafe(broadcast_trackload(cdj_id, path), loop)
 
 
     # Setup websocket server and CDJ packet sniffer
-    server  = websockets.serve(handle_websocket, opts.addr, opts.port)
-    sniffer = functools.partial(scapy.sendrecv.sniff, filter='tcp', prn=handle_packet)
+    server  = websockets.serve(handle_websocket, opts.addr, opts.port, compression=None)
+
+    # Prefer a raw packet socket where available, otherwise fall back to scapy
+    if hasattr(socket, 'AF_PACKET'):
+        sniffer = functools.partial(sniff_tcp_payloads, handle_payload)
+    else:
+        sniffer = functools.partial(
+            scapy.sendrecv.sniff,
+            filter='tcp',
+            store=False,
+            lfilter=lambda p: scapy.packet.Raw in p,
+            prn=handle_packet)
+
+    def sniffer_stopped(future):
+        """Log why the sniffer stopped, it is expected to run forever.
+        """
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Packet sniffer stopped", exc_info=future.exception())
+
 
     loop.run_until_complete(server)
-    loop.run_in_executor(None, sniffer)
+    loop.run_in_executor(None, sniffer).add_done_callback(sniffer_stopped)
     loop.run_forever()